@@ -1,20 +1,56 @@
+import re
 import sqlparse
 import statistics
 import warnings
-from collections import Counter, OrderedDict
-from sql_metadata import Parser as SQLParser
+from contextlib import contextmanager
+from functools import lru_cache
+from collections import Counter, OrderedDict, namedtuple
 from pygments import highlight
 from pygments.lexers import SqlLexer
 from pygments.formatters import HtmlFormatter, TerminalTrueColorFormatter
 from IPython.core.display import HTML, display
-from time import perf_counter
-from django.db import connection, reset_queries
+from time import perf_counter_ns
+from django.db import connection, connections, reset_queries
 from django.db.backends.base.base import BaseDatabaseWrapper
 
 from .thing import Thing
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
+# the sql of each query made by a thing and how many times each table was
+# accessed by those queries
+QuerySnapshot = namedtuple("QuerySnapshot", ["queries", "table_counts"])
+
+# django always quotes table names with double quotes, or backticks on MySQL.
+# Requiring the quotes keeps words inside interpolated string literals, like
+# 'pie from naples', from being read as tables
+TABLE_PATTERN = re.compile(r'\b(?:FROM|UPDATE|INTO|JOIN)\s+[`"](\w+)[`"]', re.IGNORECASE)
+
+# building pygments lexers and formatters resolves styles and compiles token
+# rules, so they are created once and reused for every highlighted query
+SQL_LEXER = SqlLexer()
+HTML_FORMATTER = HtmlFormatter(
+    nobackground=True,
+    style="one-dark",
+)
+# notebooks share one stylesheet for every highlighted query instead of
+# embedding it in the HTML of each query
+HTML_STYLE = f"<style>{HTML_FORMATTER.get_style_defs('.highlight')}</style>"
+TERMINAL_FORMATTER = TerminalTrueColorFormatter(
+    style="one-dark",
+)
+
+
+@lru_cache(maxsize=None)
 def is_notebook():
+    """Check if code is running in a jupyter notebook
+
+    The shell can't change while the process is running so the result is
+    computed once and cached.
+    """
     try:
         shell = get_ipython().__class__.__name__  # type: ignore
         if shell == "ZMQInteractiveShell":
@@ -27,43 +63,110 @@ def is_notebook():
         return False  # Probably standard Python interpreter
 
 
-def highlight_query(query):
+def highlight_query(query, executions=1, style=True):
     """Format and add highlights to the SQL of a django queryset
 
     Can highlight jupyter notebooks using pygment's HTML highlighter
 
     As of now only highlights using one-dark styling
+
+    Queries executed more than once are annotated with a comment containing
+    the number of `executions`.
+
+    In a jupyter notebook the HTML includes the stylesheet for the
+    highlighting unless `style` is False, for when it's displayed separately.
     """
-    query_string = query
-    formatted_string = sqlparse.format(query_string, reindent=True)
+    formatted_string = sqlparse.format(query, reindent=True)
+    if executions > 1:
+        formatted_string += f"\n-- executed {executions} times"
 
     if is_notebook():
-        formatter = HtmlFormatter(
-            full=True,
-            nobackground=True,
-            style="one-dark",
-        )
+        formatter = HTML_FORMATTER
     else:
-        formatter = TerminalTrueColorFormatter(
-            style="one-dark",
-        )
+        formatter = TERMINAL_FORMATTER
 
     hightlighted_query = highlight(
         code=formatted_string,
-        lexer=SqlLexer(),
+        lexer=SQL_LEXER,
         formatter=formatter,
     )
+    if style and is_notebook():
+        hightlighted_query = HTML_STYLE + hightlighted_query
     return hightlighted_query
 
 
-def display_query(query):
-    highlighted_query = highlight_query(query)
+@lru_cache(maxsize=1024)
+def extract_tables(query) -> tuple:
+    """Return the tables accessed by a SQL query
+
+    django generates very regular SQL so the table names can be read from
+    the identifiers following FROM, UPDATE, INTO, and JOIN instead of
+    running a full SQL parser. Each table is only reported once per query.
+
+    Results are cached by SQL string. n + 1 queries repeat the same SQL many
+    times so each distinct query only has to be matched once.
+    """
+    return tuple(dict.fromkeys(TABLE_PATTERN.findall(query)))
+
+
+@contextmanager
+def query_logging_disabled():
+    """Stop django from recording queries in `connection.queries`
+
+    Queries are logged by the debug cursor each connection wraps its cursors
+    with. Inside the block every connection makes regular cursors instead.
+    `settings.DEBUG` is left alone so the code being run behaves the same.
+    """
+    patched = []
+    for conn in connections.all():
+        patched.append((conn, conn.__dict__.get("make_debug_cursor")))
+        conn.make_debug_cursor = conn.make_cursor
+    try:
+        yield
+    finally:
+        for conn, make_debug_cursor in patched:
+            if make_debug_cursor is None:
+                del conn.make_debug_cursor
+            else:
+                conn.make_debug_cursor = make_debug_cursor
+
+
+def percentile(samples, percent):
+    """Return the `percent` percentile of a list of samples
+
+    Interpolates linearly between the two closest samples, the same as
+    numpy.percentile. statistics.quantiles isn't available before python 3.8.
+    """
+    ordered = sorted(samples)
+    position = (len(ordered) - 1) * percent / 100
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+
+def display_query(query, executions=1, style=True):
+    highlighted_query = highlight_query(query, executions, style)
     if is_notebook():
         display(HTML(highlighted_query))
     else:
         print(highlighted_query)
 
 
+def display_queries(queries):
+    """Highlight and display each distinct query in a list of SQL queries
+
+    Identical queries, like the ones made by an n + 1 query, are highlighted
+    once and annotated with how many times they were executed.
+
+    Each query is displayed as soon as it's highlighted. In a jupyter notebook
+    the stylesheet for the highlighting is displayed once before the queries.
+    """
+    if is_notebook():
+        display(HTML(HTML_STYLE))
+    for query, executions in Counter(queries).items():
+        display_query(query, executions, style=False)
+
+
 class Feel:
     """Get a feel for how the Django ORM is executing queries
 
@@ -75,6 +178,10 @@ class Feel:
 
     `reset_queries_ok` checks if it's okay to delete the query history in
     `django.db.connections.queries`. Default is True
+
+    `hydrate` checks if rows from a `queryset` should be turned into model
+    instances. Set it to False to measure only the database and driver cost
+    of the query. Default is True
     """
 
     def __init__(
@@ -85,6 +192,7 @@ class Feel:
         execution_args=None,
         request=None,
         instance=None,
+        hydrate=True,
         *args,
         **kwargs,
     ):
@@ -95,12 +203,14 @@ class Feel:
             "execution_args": execution_args,
             "request": request,
             "instance": instance,
+            "hydrate": hydrate,
         }
 
         self.thing = Thing(thing, self.execution_dict, *args, **kwargs)
         self.type = self.thing.thing_type
 
         self.__times = None
+        self.__snapshot = None
 
     def flush_queries(self) -> None:
         if self.reset_queries_ok:
@@ -119,77 +229,130 @@ class Feel:
                     f"Approaching query log limit. Currently {query_log_count} / {max_queries}"
                 )
 
+    def __get_times(self) -> list:
+        """Execute the thing `iterations` times and return each duration in
+        nanoseconds.
+
+        The first iteration warms up django's database connection and caches,
+        so it's left out of the samples unless it's the only one. The thing
+        will not be rerun every time the samples are accessed.
+
+        Queries aren't logged while timing. Logging them would add to every
+        sample and fill `connection.queries` with repeated copies.
+        """
+        if not self.__times:
+            # look everything up once so the timed window holds as little
+            # interpreter work as possible
+            executor = self.thing.executor
+            thing = self.thing.thing
+            counter = perf_counter_ns
+            times = [0] * self.iterations
+            with query_logging_disabled():
+                for i in range(self.iterations):
+                    t0 = counter()
+                    executor(thing)
+                    times[i] = counter() - t0
+            self.__times = times[1:] or times
+        return self.__times
+
     @property
     def time(self) -> float:
-        """Return the mean query time in microseconds.
+        """Return the median query time in seconds."""
+        return statistics.median(self.__get_times()) / 1e9
 
-        The query will not be rerun every time the property is accessed.
+    @property
+    def time_stats(self) -> dict:
+        """Return the mean, median, 95th percentile, minimum, and standard
+        deviation of the query time in seconds.
+
+        Uses numpy when it's installed, which is much faster for large numbers
+        of `iterations`.
         """
-        if not self.__times:
-            times = []
-            for i in range(self.iterations):
-                t0 = perf_counter()
-                self.thing.execute_thing()
-                t1 = perf_counter()
-                duration = t1 - t0
-                times.append(duration)
-            self.__times = times
-        return statistics.mean(self.__times)
+        times = self.__get_times()
+        if numpy is not None:
+            array = numpy.asarray(times) / 1e9
+            return {
+                "mean": float(array.mean()),
+                "median": float(numpy.median(array)),
+                "p95": float(numpy.percentile(array, 95)),
+                "min": float(array.min()),
+                "std": float(array.std()),
+            }
+
+        return {
+            "mean": statistics.mean(times) / 1e9,
+            "median": statistics.median(times) / 1e9,
+            "p95": percentile(times, 95) / 1e9,
+            "min": min(times) / 1e9,
+            "std": statistics.pstdev(times) / 1e9,
+        }
 
     @property
     def count(self) -> int:
-        self.flush_queries()
-        self.thing.execute_thing()
-        query_count = len(connection.queries)
-        return query_count
+        return len(self.__get_snapshot().queries)
 
     @property
     def report(self) -> None:
         table_dict = self.tables
+        duplicates = self.duplicates
         report = f"\
         \n           query count: {self.count} \
-        \n      average duration: {round((self.time * 1000), 3)} ms \
+        \n      repeated queries: {sum(duplicates.values()) - len(duplicates)} \
+        \n       median duration: {round((self.time * 1000), 3)} ms \
         \n   most accessed table: {list(table_dict.items())[0][0]} - {list(table_dict.items())[0][1]} \
         \n         unique tables: {len(table_dict)} \
         \n              accessed \
         "
         return print(report)
 
-    def __get_query_list(self) -> list:
-        """
+    def __get_snapshot(self) -> QuerySnapshot:
+        """Execute the thing once and collect the queries it made.
+
         connection.queries returns a list of dictionaries containing the
-        sql query and the time it took to execute the query. This function
-        isolates just the sql query
+        sql query and the time it took to execute the query. The sql of
+        each query and a Counter of the tables they accessed are both built
+        in a single pass over that list.
+
+        The thing will not be rerun every time the snapshot is accessed, so
+        every property reports on the same execution.
         """
-        self.flush_queries()
-        self.thing.execute_thing()
+        if self.__snapshot is None:
+            self.flush_queries()
+            self.thing.execute_thing()
 
-        queries = []
-        for query in connection.queries:
-            queries.append(query["sql"])
+            queries = []
+            table_counts = Counter()
+            for query in connection.queries:
+                sql = query["sql"]
+                queries.append(sql)
+                table_counts.update(extract_tables(sql))
 
-        return queries
+            self.__snapshot = QuerySnapshot(queries, table_counts)
+        return self.__snapshot
 
     @property
-    def sql(self, pretty=True) -> None:
-        for query in self.__get_query_list():
-            if pretty:
-                display_query(query)
-            else:
-                print(query)
+    def sql(self) -> None:
+        display_queries(self.__get_snapshot().queries)
+
+    @property
+    def sql_raw(self) -> None:
+        """Print the SQL of each query without formatting or highlighting"""
+        for query in self.__get_snapshot().queries:
+            print(query)
+
+    @property
+    def duplicates(self) -> dict:
+        """Return each SQL query that was executed more than once and how many
+        times it was executed.
+        """
+        queries = self.__get_snapshot().queries
+        return {
+            query: executions
+            for query, executions in Counter(queries).items()
+            if executions > 1
+        }
 
     @property
     def tables(self) -> OrderedDict:
-        self.flush_queries()
-        self.thing.execute_thing()
-        sql_list = [query["sql"] for query in connection.queries]
-        tables = []
-        for sql in sql_list:
-            parsed = SQLParser(sql)
-            queried_tables = parsed.tables
-            tables += queried_tables
-        table_counts = dict(Counter(tables))
-        sorted_dict = OrderedDict(
-            sorted(table_counts.items(), key=lambda x: x[1], reverse=True)
-        )
-        return sorted_dict
+        table_counts = self.__get_snapshot().table_counts
+        return OrderedDict(table_counts.most_common())
@@ -1,9 +1,89 @@
+import asyncio
 from typing import Type
 from urllib import request
-from django.http import HttpRequest, HttpResponse
+from asgiref.sync import async_to_sync
+from collections import deque
+from django.http import HttpRequest
+from django.template.response import SimpleTemplateResponse
 from django.db.models.query import QuerySet, ModelIterable
-from django.db.models.base import ModelState
+from django.db.models import Model
+from django.views.generic import View
 from inspect import signature, isclass
+from weakref import WeakKeyDictionary
+
+try:
+    from asgiref.sync import iscoroutinefunction
+except ImportError:  # asgiref < 3.6
+    from asyncio import iscoroutinefunction
+
+# django rest framework is optional. Without it no class can subclass the
+# empty tuple, so nothing is detected as a serializer
+try:
+    from rest_framework.serializers import ModelSerializer
+    SERIALIZER_BASES = (ModelSerializer,)
+except ImportError:
+    SERIALIZER_BASES = ()
+
+
+# things of these exact types are classified with a single lookup
+THING_TYPE_FAST_PATH = {QuerySet: 'queryset'}
+
+
+# classes only need their MRO checked once to know if they're a class based
+# view or a serializer. Classes aren't kept alive by the cache, so classes
+# redefined by re-running a notebook cell can still be garbage collected
+CLASS_TYPE_CACHE = WeakKeyDictionary()
+
+
+def classify_class(cls) -> str:
+    '''Return the thing type of a class based view or serializer class
+
+    Every django class based view, generic or not, subclasses View. The type
+    only depends on the class's MRO, so it's cached for each class
+    '''
+    thing_type = CLASS_TYPE_CACHE.get(cls)
+    if thing_type is None:
+        if issubclass(cls, View):
+            thing_type = 'django_cbv'
+        elif issubclass(cls, SERIALIZER_BASES):
+            thing_type = 'serializer'
+        else:
+            raise TypeError('Invalid Class')
+        CLASS_TYPE_CACHE[cls] = thing_type
+    return thing_type
+
+
+def event_loop_running() -> bool:
+    '''Check if an event loop is running in the current thread'''
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return False
+    return True
+
+
+# callables are weakly referenced so closures, bound methods, and everything
+# they capture aren't kept alive by the cache
+REQUEST_PARAM_CACHE = WeakKeyDictionary()
+
+
+def has_request_param(func) -> bool:
+    '''Check if a callable takes a `request` argument
+
+    inspect.signature is slow, so the result is cached for each callable.
+    Callables that can't be hashed or weakly referenced aren't cached
+    '''
+    try:
+        return REQUEST_PARAM_CACHE[func]
+    except (KeyError, TypeError):
+        pass
+    takes_request = 'request' in signature(func).parameters
+    try:
+        REQUEST_PARAM_CACHE[func] = takes_request
+    except TypeError:
+        pass
+    return takes_request
+
 
 class Thing():
     '''Determine the real type of a thing
@@ -12,159 +92,154 @@ class Thing():
     ['queryset', 'view', 'function', 'django_cbv', 'serializer']
     '''
 
+    __slots__ = (
+        'thing',
+        'kwargs',
+        'execution_dict',
+        'request',
+        'function',
+        'thing_type',
+        'executor',
+    )
+
     def __init__(self, thing, execution_dict, *args, **kwargs):
         self.thing = thing
         self.kwargs = kwargs
         self.execution_dict = execution_dict
+        self.request = None
+        self.function = None
 
         self.thing_type = self.find_thing_type(thing)
         self.executor = self.find_executor_type(self.thing_type)
 
     def find_thing_type(self, thing) -> str:
-        if type(thing) == QuerySet:
-            thing_type = 'queryset'
-        elif isclass(thing):
-            if self.check_django_class_based_view(thing):
-                thing_type = 'django_cbv'
-            elif self.check_serializer(thing):
-                thing_type = 'serializer'
-            else:
-                raise TypeError('Invalid Class')
-        elif callable(thing): # all classes are callable but not all callables are classes
-            if self.check_django_view(thing):
-                thing_type = 'view'
-            else:
-                thing_type = 'function'
-        elif self.check_model_instance(thing):
-            thing_type = 'model_instance'
-        else:
-            raise TypeError('Invalid Thing. Valid things are querysets, django class based views, serializers, django views, functions, and model instances.')
-        return thing_type
+        thing_type = THING_TYPE_FAST_PATH.get(type(thing))
+        if thing_type is not None:
+            return thing_type
+
+        if isinstance(thing, type):
+            return classify_class(thing)
+        if callable(thing): # all classes are callable but not all callables are classes
+            return 'view' if self.check_django_view(thing) else 'function'
+        if isinstance(thing, Model):
+            return 'model_instance'
+        raise TypeError('Invalid Thing. Valid things are querysets, django class based views, serializers, django views, functions, and model instances.')
 
     def get_request_or_create(self) -> HttpRequest:
-        request = self.execution_dict['request']
-        if request == None:
-            request = HttpRequest()
-        return request
+        '''Return the request passed to Feel or create an empty GET request
 
-    def check_model_instance(self, thing):
-        try:
-            state = thing.__dict__['_state']
-            if type(state) == ModelState:
-                return True
-            else:
-                return False
-        except (KeyError, AttributeError):
-            return False
+        The request is only looked up once and is reused every time the
+        thing is executed.
+        '''
+        if self.request is None:
+            request = self.execution_dict['request']
+            if request is None:
+                request = HttpRequest()
+            if request.method is None:
+                request.method = 'GET'
+            self.request = request
+        return self.request
+
+    def get_function(self):
+        '''Return a synchronous function that runs a view, class based view,
+        or function
+
+        Class based views are turned into a view with as_view() and async
+        views and functions are wrapped with async_to_sync. Both only happen
+        once and the function is reused every time the thing is executed.
+
+        async_to_sync can't be used in a thread that's already running an
+        event loop, like a jupyter notebook cell, so async views are only
+        supported outside of notebooks.
+        '''
+        if self.function is None:
+            function = self.thing.as_view() if isclass(self.thing) else self.thing
+            if iscoroutinefunction(function):
+                if event_loop_running():
+                    raise RuntimeError('Async views and functions cannot be run from a thread with a running event loop, like a jupyter notebook. Profile them from a script or the django shell instead.')
+                function = async_to_sync(function)
+            self.function = function
+        return self.function
 
     def check_django_view(self, thing):
-        parameters = list(signature(thing).parameters)
-        if 'request' not in parameters:
-            return False
-        
-        request = self.get_request_or_create()
-        response = thing(request)
-        if type(response) == HttpResponse:
-            return True
-        else:
-            return False
-
-    def check_django_class_based_view(self, thing):
-        valid_cbvs = [
-            "View",
-            "TemplateView",
-            "RedirectView",
-            "ArchiveIndexView",
-            "YearArchiveView",
-            "MonthArchiveView",
-            "WeekArchiveView",
-            "DayArchiveView",
-            "TodayArchiveView",
-            "DateDetailView",
-            "DetailView",
-            "ListView",
-            "GenericViewError",
-        ]
-        mro = thing.__mro__
-        intersection = [x for x in mro if any(cbv in str(x) for cbv in valid_cbvs)]
-        if intersection:
-            return True
-        else:
-            return False
+        '''Views are functions that take a `request` argument
 
-    def check_serializer(self, thing):
-        mro = thing.__mro__
-        valid_parent_class = 'rest_framework.serializers.ModelSerializer'
-        if any(valid_parent_class in str(parent_class) for parent_class in mro):
-            return True
-        else:
-            return False
+        The view isn't called to check what it returns. That would run the
+        view and all of its queries an extra time just to classify it.
+        '''
+        return has_request_param(thing)
 
     def find_executor_type(self, thing_type):
-        if thing_type == 'queryset':
-            return self.execute_queryset
-        elif thing_type == 'view':
-            return self.execute_view
-        elif thing_type == 'function':
-            return self.execute_function
-        elif thing_type == 'django_cbv':
-            return self.execute_django_cbv
-        elif thing_type == 'serializer':
-            return self.execute_serializer
-        elif thing_type == 'model_instance':
-            return self.execute_model_instance
-        else:
-            raise TypeError(f'Invalid Type: {thing_type}')
+        try:
+            executor_name = self.EXECUTORS[thing_type]
+        except KeyError:
+            raise TypeError(f'Invalid Type: {thing_type}') from None
+        return getattr(self, executor_name)
 
     def execute_queryset(self, thing):
         '''Run a Queryset
         
         when list() is called on a queryset the queryset's _result_cache
-        is checked first. By calling list on the an instance of ModelIterable
-        we can be sure that the queries are actually being run. 
+        is checked first. By iterating over an instance of ModelIterable
+        we can be sure that the queries are actually being run. The instances
+        are drained into an empty deque so they're never stored in a list.
+
+        ModelIterable doesn't run prefetch_related lookups, so querysets with
+        prefetches are evaluated from a fresh copy with an empty _result_cache
+        instead. That way the prefetch queries are run and counted too.
+
+        If `hydrate` is False the queryset's compiled SQL is executed directly
+        and the rows are fetched without building model instances. Prefetch
+        lookups aren't run.
         '''
-        try:
-            list(ModelIterable(thing))
-        except Exception as e:
-            raise e
+        if self.execution_dict['hydrate']:
+            if thing._prefetch_related_lookups:
+                deque(thing.all(), maxlen=0)
+            else:
+                deque(ModelIterable(thing), maxlen=0)
+        else:
+            compiler = thing.query.get_compiler(using=thing.db)
+            compiler.execute_sql(chunked_fetch=False)
 
     def execute_view(self, thing):
         request = self.get_request_or_create()
-        try:
-            thing(request)
-        except Exception as e:
-            raise e
+        self.get_function()(request)
 
     def execute_function(self, thing):
-        try:
-            thing()
-        except Exception as e:
-            raise e
+        self.get_function()()
 
     def execute_django_cbv(self, thing):
         request = self.get_request_or_create()
-        request.method = 'GET'
-        try:
-            response = thing.as_view()(request)
+        response = self.get_function()(request)
+        # only template responses defer rendering. Other responses, like
+        # redirects, are complete and don't have a render method
+        if isinstance(response, SimpleTemplateResponse):
             response.render()
-        except Exception as e:
-            raise e
 
     def execute_serializer(self, thing):
+        '''Serialize every instance of the serializer's model
+
+        The queryset is always serialized with `many=True` so that only the
+        queries made by the serializer itself are counted. DRF handles
+        querysets with zero or one rows.
+        '''
         model = thing.Meta.model
         queryset = model.objects.all()
-        many = True if len(queryset) > 1 else False
-        try:
-            serializer_execution = thing(instance=queryset, many=many)
-            serializer_execution.data
-        except Exception as e:
-            raise e
+        serializer_execution = thing(instance=queryset, many=True)
+        serializer_execution.data
 
     def execute_model_instance(self, thing):
-        try:
-            thing.refresh_from_db()
-        except Exception as e:
-            raise e
+        thing.refresh_from_db()
+
+    # maps each thing type to the name of the method that executes it
+    EXECUTORS = {
+        'queryset': 'execute_queryset',
+        'view': 'execute_view',
+        'function': 'execute_function',
+        'django_cbv': 'execute_django_cbv',
+        'serializer': 'execute_serializer',
+        'model_instance': 'execute_model_instance',
+    }
 
     def execute_thing(self):
         self.executor(self.thing)
\ No newline at end of file
@@ -1,6 +1,7 @@
+from asgiref.sync import sync_to_async
 from django.shortcuts import render
 from django.urls import reverse_lazy
-from django.views.generic import ListView, DetailView, DeleteView
+from django.views.generic import ListView, DetailView, DeleteView, RedirectView
 
 from .models import Pizza, Topping
 
@@ -14,6 +15,9 @@ def pizza_list_optimized(request):
     pizzas = Pizza.objects.all().prefetch_related('toppings')
     return render(request, 'test_app/pizza_list.html', {'pizzas': pizzas})
 
+async def pizza_list_async(request):
+    return await sync_to_async(pizza_list_optimized)(request)
+
 class PizzaListView(ListView):
     model = Pizza
     context_object_name = 'pizzas'
@@ -21,4 +25,7 @@ class PizzaListView(ListView):
 
 class PizzaDeleteView(DeleteView):
     model = Pizza
-    success_url = reverse_lazy('pizza_list_listview')
\ No newline at end of file
+    success_url = reverse_lazy('pizza_list_listview')
+
+class PizzaRedirectView(RedirectView):
+    pattern_name = 'pizza_list_listview'
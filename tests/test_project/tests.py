@@ -1,7 +1,17 @@
+import django_queryset_feeler
 from django_queryset_feeler import Feel
 
+import asyncio
+import gc
+import re
+import weakref
+from dataclasses import dataclass
+from io import StringIO
+from unittest.mock import patch
+
 from django.test import TestCase
 from django.conf import settings
+from django.db import connection, reset_queries
 
 from test_app.models import Pizza, Topping
 from test_app.serializers import PizzaSerializer, ToppingSerializer
@@ -51,6 +61,36 @@ class TestQuerysets(TestCase):
         feel = Feel(queryset)
         self.assertEqual(feel.count, 1)
 
+    def test_properties_share_one_execution(self):
+        feel = Feel(Pizza.objects.all())
+        self.assertEqual(feel.count, 1)
+        reset_queries()
+        feel.tables
+        feel.duplicates
+        self.assertEqual(feel.count, 1)
+        self.assertEqual(len(connection.queries), 0)
+
+    def test_prefetched_queryset(self):
+        queryset = Pizza.objects.prefetch_related("toppings")
+        list(queryset)
+        feel = Feel(queryset)
+        self.assertEqual(feel.count, 2)
+
+    def test_queryset_without_hydration(self):
+        queryset = Pizza.objects.filter(toppings__vegetarian=True)
+        with patch.object(Pizza, "from_db") as from_db:
+            Feel(queryset).count
+            from_db.assert_called()
+            from_db.reset_mock()
+            feel = Feel(queryset, hydrate=False)
+            self.assertEqual(feel.count, 1)
+            from_db.assert_not_called()
+
+    def test_prefetched_queryset_without_hydration(self):
+        queryset = Pizza.objects.prefetch_related("toppings")
+        self.assertEqual(Feel(queryset).count, 2)
+        self.assertEqual(Feel(queryset, hydrate=False).count, 1)
+
 
 class TestClassBasedViews(TestCase):
     def setUp(self) -> None:
@@ -60,6 +100,21 @@ class TestClassBasedViews(TestCase):
         feel = Feel(views.PizzaListView)
         self.assertEqual(feel.count, 7)
 
+    def test_class_not_kept_alive(self):
+        class PizzaView(views.PizzaListView):
+            pass
+
+        Feel(PizzaView)
+        self.assertIn(PizzaView, django_queryset_feeler.thing.CLASS_TYPE_CACHE)
+        view_ref = weakref.ref(PizzaView)
+        del PizzaView
+        gc.collect()
+        self.assertIsNone(view_ref())
+
+    def test_redirect_view(self):
+        feel = Feel(views.PizzaRedirectView)
+        self.assertEqual(feel.count, 0)
+
     def test_delete_view(self):
         self.assertRaises(TypeError, Feel(views.DeleteView))
 
@@ -76,6 +131,11 @@ class TestSerializers(TestCase):
         feel = Feel(ToppingSerializer)
         self.assertEqual(feel.count, 1)
 
+    def test_serializer_single_instance(self):
+        Pizza.objects.exclude(name="Hawaiian").delete()
+        feel = Feel(PizzaSerializer)
+        self.assertEqual(feel.count, 2)
+
 
 class TestViews(TestCase):
     def setUp(self) -> None:
@@ -89,6 +149,37 @@ class TestViews(TestCase):
         feel = Feel(views.pizza_list_unoptimized)
         self.assertEqual(feel.count, 7)
 
+    def test_view_not_executed_on_init(self):
+        reset_queries()
+        feel = Feel(views.pizza_list_unoptimized)
+        self.assertEqual(feel.type, "view")
+        self.assertEqual(len(connection.queries), 0)
+
+    def test_async_view(self):
+        feel = Feel(views.pizza_list_async)
+        self.assertEqual(feel.type, "view")
+        self.assertEqual(feel.count, 2)
+
+    def test_view_not_kept_alive(self):
+        def view(request):
+            return list(Pizza.objects.all())
+
+        Feel(view)
+        self.assertIn(view, django_queryset_feeler.thing.REQUEST_PARAM_CACHE)
+        view_ref = weakref.ref(view)
+        del view
+        gc.collect()
+        self.assertIsNone(view_ref())
+
+    def test_async_view_in_event_loop(self):
+        feel = Feel(views.pizza_list_async)
+
+        async def count():
+            return feel.count
+
+        with self.assertRaisesMessage(RuntimeError, "running event loop"):
+            asyncio.run(count())
+
 
 class TestFunctions(TestCase):
     def setUp(self) -> None:
@@ -103,6 +194,18 @@ class TestFunctions(TestCase):
         feel = Feel(example_function)
         self.assertEqual(feel.count, 4)
 
+    def test_unhashable_callable(self):
+        @dataclass
+        class Job:
+            name: str = "Hawaiian"
+
+            def __call__(self):
+                Pizza.objects.get(name=self.name)
+
+        feel = Feel(Job())
+        self.assertEqual(feel.type, "function")
+        self.assertEqual(feel.count, 1)
+
 
 class TestModelInstance(TestCase):
     def setUp(self) -> None:
@@ -112,3 +215,146 @@ class TestModelInstance(TestCase):
         instance = Pizza.objects.get(name="Hawaiian")
         feel = Feel(instance)
         self.assertEqual(feel.count, 1)
+
+
+class TestTables(TestCase):
+    def setUp(self) -> None:
+        create_models()
+
+    def test_unoptimized_view_tables(self):
+        feel = Feel(views.pizza_list_unoptimized)
+        self.assertEqual(
+            feel.tables,
+            {
+                "test_app_topping": 6,
+                "test_app_pizza_toppings": 6,
+                "test_app_pizza": 1,
+            },
+        )
+
+    def test_update_tables(self):
+        def update_pizzas():
+            Pizza.objects.filter(toppings__vegetarian=False).update(name="Carnivore")
+
+        feel = Feel(update_pizzas)
+        self.assertEqual(list(feel.tables)[0], "test_app_pizza")
+
+    def test_string_literal_tables(self):
+        queryset = Pizza.objects.filter(name="Pie from Naples")
+        feel = Feel(queryset)
+        self.assertEqual(feel.tables, {"test_app_pizza": 1})
+
+
+class TestSQL(TestCase):
+    def setUp(self) -> None:
+        create_models()
+
+    def test_sql_raw(self):
+        feel = Feel(Pizza.objects.all())
+        with patch("sys.stdout", new_callable=StringIO) as stdout:
+            feel.sql_raw
+        self.assertEqual(
+            stdout.getvalue(),
+            str(Pizza.objects.all().query) + "\n",
+        )
+
+    def test_sql_reindents_values_with_newlines(self):
+        def update_function():
+            Pizza.objects.filter(name="Hawaiian").update(name="multi\nline")
+
+        feel = Feel(update_function)
+        with patch("sys.stdout", new_callable=StringIO) as stdout:
+            feel.sql
+        output = re.sub(r"\x1b\[[0-9;]*m", "", stdout.getvalue())
+        self.assertIn("\nWHERE", output)
+
+    def test_notebook_highlight_includes_style(self):
+        query = str(Pizza.objects.all().query)
+        with patch("django_queryset_feeler.is_notebook", return_value=True):
+            styled = django_queryset_feeler.highlight_query(query)
+            unstyled = django_queryset_feeler.highlight_query(query, style=False)
+        self.assertTrue(styled.startswith(django_queryset_feeler.HTML_STYLE))
+        self.assertNotIn("<style>", unstyled)
+
+
+class TestDuplicates(TestCase):
+    def setUp(self) -> None:
+        create_models()
+
+    def test_duplicates(self):
+        def repeated_function():
+            for i in range(3):
+                Pizza.objects.get(name="Hawaiian")
+            list(Topping.objects.all())
+
+        feel = Feel(repeated_function)
+        duplicates = feel.duplicates
+        self.assertEqual(list(duplicates.values()), [3])
+        self.assertIn("Hawaiian", list(duplicates)[0])
+
+    def test_sql_collapses_duplicates(self):
+        def repeated_function():
+            for i in range(3):
+                Pizza.objects.get(name="Hawaiian")
+            list(Topping.objects.all())
+
+        feel = Feel(repeated_function)
+        with patch("sys.stdout", new_callable=StringIO) as stdout:
+            feel.sql
+        # remove the terminal color codes added by the highlighting
+        output = re.sub(r"\x1b\[[0-9;]*m", "", stdout.getvalue())
+        self.assertEqual(output.count("'Hawaiian'"), 1)
+        self.assertEqual(output.count("-- executed 3 times"), 1)
+        self.assertEqual(output.count("-- executed"), 1)
+        self.assertEqual(output.count('FROM "test_app_topping"'), 1)
+
+    def test_no_duplicates(self):
+        feel = Feel(views.pizza_list_optimized)
+        self.assertEqual(feel.duplicates, {})
+
+
+class TestTime(TestCase):
+    def setUp(self) -> None:
+        create_models()
+
+    def test_time_stats(self):
+        feel = Feel(Pizza.objects.all(), iterations=8)
+        stats = feel.time_stats
+        self.assertEqual(feel.time, stats["median"])
+        self.assertLessEqual(stats["min"], stats["median"])
+        self.assertLessEqual(stats["median"], stats["p95"])
+
+    def test_time_stats_without_numpy(self):
+        feel = Feel(Pizza.objects.all())
+        times = [i * 1e9 for i in range(1, 12)]
+        with patch("django_queryset_feeler.numpy", None), patch.object(
+            Feel, "_Feel__get_times", return_value=times
+        ):
+            stats = feel.time_stats
+        self.assertEqual(stats["median"], 6)
+        self.assertEqual(stats["p95"], 10.5)
+        self.assertEqual(stats["min"], 1)
+
+    def test_single_iteration(self):
+        feel = Feel(Pizza.objects.all(), iterations=1)
+        self.assertGreater(feel.time, 0)
+        self.assertEqual(feel.time_stats["min"], feel.time)
+
+    def test_time_does_not_log_queries(self):
+        feel = Feel(views.pizza_list_unoptimized, iterations=4)
+        reset_queries()
+        feel.time
+        self.assertEqual(len(connection.queries), 0)
+
+    def test_time_keeps_debug_setting(self):
+        debug_values = []
+
+        def debug_function():
+            debug_values.append(settings.DEBUG)
+            list(Pizza.objects.all())
+
+        Feel(debug_function, iterations=4).time
+        self.assertEqual(debug_values, [True] * 4)
+        reset_queries()
+        list(Pizza.objects.all())
+        self.assertEqual(len(connection.queries), 1)